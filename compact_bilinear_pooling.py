@@ -4,129 +4,294 @@ from __future__ import absolute_import, division, print_function
 import numpy as np
 import tensorflow as tf
 
-def _fft(bottom, sequential):
-    if sequential:
-        return
-    else:
-        return tf.signal.fft(bottom)
+def _count_sketch_pair(bottom1_flat, bottom2_flat, perm, rand_h, rand_s,
+                       output_dim):
+    """
+    Compute the tensor count sketches of both inputs in one scatter: every
+    input-dim column is scaled by +-1 (`rand_s`) and scatter-added into one of
+    `output_dim` buckets (`rand_h`) with a dense segment-sum kernel. Since
+    segment_sum only reduces over the leading axis, both inputs are
+    concatenated along the feature axis first (with the second input's bucket
+    indices offset by `output_dim`), so the two branches share a single
+    transpose pair and scatter launch instead of one each.
+    Args:
+        bottom1_flat: 2D Tensor of shape [N, input_dim1].
+        bottom2_flat: 2D Tensor of shape [N, input_dim2].
+        perm: an 1D int32 Tensor permuting the concatenated feature axis so
+              that `rand_h` is sorted ascending.
+        rand_h: an 1D sorted int32 Tensor of shape [input_dim1 + input_dim2]
+                with bucket indices in `[0, 2*output_dim)`; the second input's
+                columns map to `[output_dim, 2*output_dim)`.
+        rand_s: an 1D int8 Tensor of 1 and -1, permuted like `rand_h`.
+        output_dim: the output dimensions of compact bilinear pooling.
+    Returns:
+        a dense float32 Tensor of shape [N, 2, output_dim] holding both
+        sketches stacked along axis 1, so a single batched FFT can transform
+        them in one call.
 
-def _ifft(bottom, sequential):
-    if sequential:
-        return
-    else:
-        return tf.signal.ifft(bottom)
+    The scale-and-scatter step is memory bound, so it runs in bfloat16 to
+    halve its bandwidth; the result is cast back to float32 for the FFT,
+    which has no reduced-precision kernel. The +-1 scaling is a pure sign
+    flip, applied as a select on the int8 signs rather than a multiply.
+    Gathering the columns into bucket order up front gives the scatter
+    sorted keys, so consecutive rows hit the same bucket. The reduction uses
+    unsorted_segment_sum rather than segment_sum because only the former has
+    an XLA kernel and a static (num_segments) output shape - segment_sum's
+    output depends on the runtime value of the largest id, which must-compile
+    jit_compile=True cannot handle.
+    """
+    bottom = tf.cast(tf.concat([bottom1_flat, bottom2_flat], axis=1), tf.bfloat16)
+    bottom = tf.gather(bottom, perm, axis=1)
+    scaled = tf.where(rand_s[None, :] > 0, bottom, -bottom)
+    sketches = tf.math.unsorted_segment_sum(
+        tf.transpose(scaled), rand_h, 2*output_dim)
+    sketches = tf.cast(tf.transpose(sketches), tf.float32)
+    return tf.reshape(sketches, [-1, 2, output_dim])
+
+# Below this transform length the FFT-library dispatch overhead dominates the
+# transform itself, so an XLA-fused in-graph radix-2 butterfly is used instead.
+_LUT_FFT_MAX_LEN = 512
+
+def _twiddle_lut(fft_len):
+    """
+    Twiddle factor lookup table for `_radix2_fft`, laid out stage-major:
+    stage s (half-size m = 2**s) occupies lut[m-1 : 2*m-1] and holds
+    exp(-2*pi*i*k / 2**(s+1)) for k in [0, m).
+    """
+    lut = np.empty(fft_len - 1, dtype=np.complex64)
+    m = 1
+    while m < fft_len:
+        k = np.arange(m)
+        lut[m - 1:2*m - 1] = np.exp(-2j * np.pi * k / (2*m))
+        m *= 2
+    return lut
+
+def _bit_reverse_indices(fft_len):
+    """Input permutation for the decimation-in-time radix-2 butterfly."""
+    bits = (fft_len - 1).bit_length()
+    idx = np.arange(fft_len)
+    rev = np.zeros_like(idx)
+    for _ in range(bits):
+        rev = (rev << 1) | (idx & 1)
+        idx >>= 1
+    return rev
+
+def _radix2_fft(x, lut, bitrev, inverse=False):
+    """
+    Iterative radix-2 FFT over the last axis of `x` (complex, power-of-two
+    length) built from gathers and elementwise multiplies against the
+    precomputed twiddle LUT. The Python loop unrolls at trace time, so under
+    XLA the butterfly stages fuse with the surrounding multiplies and no
+    FFT-library plan is dispatched.
+    """
+    n = int(lut.shape[0]) + 1
+    lead = tf.shape(x)[:-1]
+    x = tf.gather(x, bitrev, axis=-1)
+    x = tf.reshape(x, [-1, n])
+    if inverse:
+        x = tf.math.conj(x)
+    m = 1
+    while m < n:
+        blocks = tf.reshape(x, [-1, n // (2*m), 2, m])
+        even = blocks[:, :, 0, :]
+        odd = blocks[:, :, 1, :]
+        t = odd * lut[m - 1:2*m - 1]
+        x = tf.reshape(tf.concat([even + t, even - t], axis=-1), [-1, n])
+        m *= 2
+    if inverse:
+        x = tf.math.conj(x) / tf.cast(n, x.dtype)
+    return tf.reshape(x, tf.concat([lead, [n]], axis=0))
+
+def _split_sizes(n, chunk):
+    sizes = [chunk] * (n // chunk)
+    if n % chunk:
+        sizes.append(n % chunk)
+    return sizes
+
+def _batched_rfft(x, fft_length, chunk):
+    """
+    Forward real FFT over the last axis of `x`, batched over all leading
+    axes in a single transform. When the statically known leading dimension
+    exceeds `chunk`, tile along it in `chunk`-row pieces to bound the
+    transform's working set instead of falling back to per-row FFTs.
+    """
+    n = x.get_shape().as_list()[0]
+    if n is None or n <= chunk:
+        return tf.signal.rfft(x, fft_length=fft_length)
+    return tf.concat(
+        [tf.signal.rfft(c, fft_length=fft_length)
+         for c in tf.split(x, num_or_size_splits=_split_sizes(n, chunk), axis=0)], 0)
 
-def _generate_sketch_matrix(rand_h, rand_s, output_dim):
+def _batched_irfft(x, fft_length, chunk):
+    """Inverse counterpart of `_batched_rfft`."""
+    n = x.get_shape().as_list()[0]
+    if n is None or n <= chunk:
+        return tf.signal.irfft(x, fft_length=fft_length)
+    return tf.concat(
+        [tf.signal.irfft(c, fft_length=fft_length)
+         for c in tf.split(x, num_or_size_splits=_split_sizes(n, chunk), axis=0)], 0)
+
+@tf.function(jit_compile=True, reduce_retracing=True)
+def _cbp_forward(bottom1_flat, bottom2_flat, perm, rand_h, rand_s, output_dim,
+                 fft_len, compute_size, fft_lut, fft_bitrev):
     """
-    Return a sparse matrix used for tensor sketch operation in compact bilinear
-    pooling
+    Tensor body of compact bilinear pooling: count sketch of both inputs,
+    FFT convolution, back to the spatial domain. `output_dim` is a Python
+    int so it becomes a compile-time constant under XLA.
     Args:
-        rand_h: an 1D numpy array containing indices in interval `[0, output_dim)`.
-        rand_s: an 1D numpy array of 1 and -1, having the same shape as `rand_h`.
+        bottom1_flat: 2D Tensor of shape [N, input_dim1].
+        bottom2_flat: 2D Tensor of shape [N, input_dim2].
+        perm, rand_h, rand_s: count sketch permutation, sorted bucket indices
+                 and signs, see `_count_sketch_pair`.
         output_dim: the output dimensions of compact bilinear pooling.
+        fft_len: transform length; `output_dim` when it is a power of two
+                 (plain circular convolution), otherwise a power of two of at
+                 least `2*output_dim - 1` so the FFT library can use its fast
+                 radix-2/4/8 plans. In the padded case the transform computes
+                 the *linear* convolution of the zero-padded sketches, and the
+                 wrapped tail is folded back below to recover the exact
+                 length-`output_dim` circular convolution - slicing alone
+                 would drop those wrap-around terms and no longer be the
+                 count-sketch estimator.
+        fft_lut, fft_bitrev: twiddle LUT and bit-reversal permutation for the
+                 in-graph `_radix2_fft`, or None to use the FFT library.
     Returns:
-        a sparse matrix of shape [input_dim, output_dim] for tensor sketch.
+        a dense Tensor of shape [N, output_dim].
     """
+    sketches = _count_sketch_pair(bottom1_flat, bottom2_flat,
+                                  perm, rand_h, rand_s, output_dim)
 
-    # Generate a sparse matrix for tensor count sketch
-    rand_h = rand_h.astype(np.int64)
-    rand_s = rand_s.astype(np.float32)
-    assert(rand_h.ndim==1 and rand_s.ndim==1 and len(rand_h)==len(rand_s))
-    assert(np.all(rand_h >= 0) and np.all(rand_h < output_dim))
+    if fft_lut is None:
+        ffts = _batched_rfft(sketches, [fft_len], compute_size)
 
-    input_dim = len(rand_h)
-    indices = np.concatenate((np.arange(input_dim)[..., np.newaxis],
-                              rand_h[..., np.newaxis]), axis=1)
-    sparse_sketch_matrix = tf.sparse.reorder(
-        tf.sparse.SparseTensor(indices, rand_s, [input_dim, output_dim]))
-    return sparse_sketch_matrix
+        fft_product = tf.multiply(ffts[:, 0, :], ffts[:, 1, :])
 
-def compact_bilinear_pooling_layer(bottom1, bottom2, output_dim,
-    rand_h_1=None, rand_s_1=None, rand_h_2=None, rand_s_2=None,
-    seed_h_1=1, seed_s_1=3, seed_h_2=5, seed_s_2=7, sequential=False,
-    compute_size=128):
+        cbp_flat = _batched_irfft(fft_product, [fft_len], compute_size)
+    else:
+        pad = [[0, 0], [0, 0], [0, fft_len - output_dim]]
+        ffts = _radix2_fft(tf.cast(tf.pad(sketches, pad), tf.complex64),
+                           fft_lut, fft_bitrev)
+
+        fft_product = tf.multiply(ffts[:, 0, :], ffts[:, 1, :])
+
+        cbp_flat = tf.math.real(
+            _radix2_fft(fft_product, fft_lut, fft_bitrev, inverse=True))
+
+    if fft_len == output_dim:
+        return cbp_flat
+    tail = tf.pad(cbp_flat[:, output_dim:2*output_dim - 1], [[0, 0], [0, 1]])
+    return cbp_flat[:, :output_dim] + tail
+
+
+class CompactBilinearPooling(tf.keras.layers.Layer):
     """
     Compute compact bilinear pooling over two bottom inputs. Reference:
     Yang Gao, et al. "Compact Bilinear Pooling." in Proceedings of IEEE
     Conference on Computer Vision and Pattern Recognition (2016).
     Akira Fukui, et al. "Multimodal Compact Bilinear Pooling for Visual Question
     Answering and Visual Grounding." arXiv preprint arXiv:1606.01847 (2016).
-    Args:
+
+    The count sketch indices (`rand_h_*`) and signs (`rand_s_*`) are generated
+    once in `build` from the seeds and stored as constants on the layer, so
+    `call` contains only tensor ops and nothing retraces per forward pass.
+
+    Call with a list of two inputs:
         bottom1: 1st input, 4D Tensor of shape [batch_size, height, width, input_dim1].
         bottom2: 2nd input, 4D Tensor of shape [batch_size, height, width, input_dim2].
-        output_dim: output dimension for compact bilinear pooling.
-        sum_pool: (Optional) If True, sum the output along height and width
-                  dimensions and return output shape [batch_size, output_dim].
-                  Otherwise return [batch_size, height, width, output_dim].
-                  Default: True.
-        rand_h_1: (Optional) an 1D numpy array containing indices in interval
-                  `[0, output_dim)`. Automatically generated from `seed_h_1`
-                  if is None.
-        rand_s_1: (Optional) an 1D numpy array of 1 and -1, having the same shape
-                  as `rand_h_1`. Automatically generated from `seed_s_1` if is
-                  None.
-        rand_h_2: (Optional) an 1D numpy array containing indices in interval
-                  `[0, output_dim)`. Automatically generated from `seed_h_2`
-                  if is None.
-        rand_s_2: (Optional) an 1D numpy array of 1 and -1, having the same shape
-                  as `rand_h_2`. Automatically generated from `seed_s_2` if is
-                  None.
-        sequential: (Optional) if True, use the sequential FFT and IFFT
-                    instead of tf.batch_fft or tf.batch_ifft to avoid
-                    out-of-memory (OOM) error.
-                    Note: sequential FFT and IFFT are only available on GPU
-                    Default: True.
-    Returns:
-        Compact bilinear pooled results of shape [batch_size, output_dim] or
-        [batch_size, height, width, output_dim], depending on `sum_pool`.
     """
 
-    # Static shapes are needed to construction count sketch matrix
-    input_dim1 = bottom1.get_shape().as_list()[-1]
-    input_dim2 = bottom2.get_shape().as_list()[-1]
-
-
-    if rand_h_1 is None:
-        np.random.seed(seed_h_1)
-        rand_h_1 = np.random.randint(output_dim, size=input_dim1)
-    if rand_s_1 is None:
-        np.random.seed(seed_s_1)
-        rand_s_1 = 2*np.random.randint(2, size=input_dim1) - 1
-    sparse_sketch_matrix1 = _generate_sketch_matrix(rand_h_1, rand_s_1, output_dim)
-
+    def __init__(self, output_dim,
+                 seed_h_1=1, seed_s_1=3, seed_h_2=5, seed_s_2=7,
+                 compute_size=4096, **kwargs):
+        super(CompactBilinearPooling, self).__init__(**kwargs)
+        self.output_dim = output_dim
+        self.seed_h_1 = seed_h_1
+        self.seed_s_1 = seed_s_1
+        self.seed_h_2 = seed_h_2
+        self.seed_s_2 = seed_s_2
+        self.compute_size = compute_size
+        # Power-of-two lengths hit the FFT library's fast radix-2/4/8 plans.
+        # When output_dim already is one, transform at that length directly;
+        # otherwise the transform must cover the full linear convolution
+        # (>= 2*output_dim - 1) so its wrapped tail can be folded back into
+        # the exact length-output_dim circular convolution.
+        if output_dim & (output_dim - 1):
+            self.fft_len = 1 << (2*output_dim - 2).bit_length()
+        else:
+            self.fft_len = output_dim
+        if self.fft_len <= _LUT_FFT_MAX_LEN:
+            self.fft_lut = tf.constant(_twiddle_lut(self.fft_len))
+            self.fft_bitrev = tf.constant(_bit_reverse_indices(self.fft_len),
+                                          dtype=tf.int32)
+        else:
+            self.fft_lut = None
+            self.fft_bitrev = None
 
-    if rand_h_2 is None:
-        np.random.seed(seed_h_2)
-        rand_h_2 = np.random.randint(output_dim, size=input_dim2)
-    if rand_s_2 is None:
-        np.random.seed(seed_s_2)
-        rand_s_2 = 2*np.random.randint(2, size=input_dim2) - 1
-    sparse_sketch_matrix2 = _generate_sketch_matrix(rand_h_2, rand_s_2, output_dim)
+    def build(self, input_shapes):
+        shape1, shape2 = input_shapes
+        input_dim1 = int(shape1[-1])
+        input_dim2 = int(shape2[-1])
 
+        # init_scope keeps the index construction eager even when build is
+        # triggered from inside a traced graph.
+        with tf.init_scope():
+            rand_h_1 = tf.random.stateless_uniform(
+                [input_dim1], seed=[self.seed_h_1, 0],
+                minval=0, maxval=self.output_dim, dtype=tf.int32)
+            rand_s_1 = 2*tf.random.stateless_uniform(
+                [input_dim1], seed=[self.seed_s_1, 0],
+                minval=0, maxval=2, dtype=tf.int32) - 1
 
-    bottom1_flat = tf.reshape(bottom1, [-1, input_dim1])
-    bottom2_flat = tf.reshape(bottom2, [-1, input_dim2])
-    print('bottom1:',bottom1_flat)
+            rand_h_2 = tf.random.stateless_uniform(
+                [input_dim2], seed=[self.seed_h_2, 0],
+                minval=0, maxval=self.output_dim, dtype=tf.int32)
+            rand_s_2 = 2*tf.random.stateless_uniform(
+                [input_dim2], seed=[self.seed_s_2, 0],
+                minval=0, maxval=2, dtype=tf.int32) - 1
 
+            # Combined vectors for the fused two-input scatter: the second
+            # input's buckets live in [output_dim, 2*output_dim). Sorting the
+            # buckets once here (and permuting the feature axis to match in
+            # the forward pass) hands the scatter sorted keys, so consecutive
+            # columns reduce into the same bucket without contention.
+            rand_h = tf.concat([rand_h_1, rand_h_2 + self.output_dim], axis=0)
+            rand_s = tf.cast(tf.concat([rand_s_1, rand_s_2], axis=0), tf.int8)
+            self.perm = tf.argsort(rand_h)
+            self.rand_h = tf.gather(rand_h, self.perm)
+            self.rand_s = tf.gather(rand_s, self.perm)
 
-    sketch1 = tf.transpose(tf.sparse.sparse_dense_matmul(sparse_sketch_matrix1,
-        bottom1_flat, adjoint_a=True, adjoint_b=True))
+        super(CompactBilinearPooling, self).build(input_shapes)
 
-    sketch2 = tf.transpose(tf.sparse.sparse_dense_matmul(sparse_sketch_matrix2,
-        bottom2_flat, adjoint_a=True, adjoint_b=True))
+    def call(self, inputs, **kwargs):
+        bottom1, bottom2 = inputs
 
+        input_dim1 = bottom1.get_shape().as_list()[-1]
+        input_dim2 = bottom2.get_shape().as_list()[-1]
 
-    fft1 = _fft(tf.complex(real=sketch1, imag=tf.zeros_like(sketch1)),
-                sequential)
-    fft2 = _fft(tf.complex(real=sketch2, imag=tf.zeros_like(sketch2)),
-                sequential)
+        bottom1_flat = tf.reshape(bottom1, [-1, input_dim1])
+        bottom2_flat = tf.reshape(bottom2, [-1, input_dim2])
 
-    fft_product = tf.multiply(fft1, fft2)
+        cbp_flat = _cbp_forward(bottom1_flat, bottom2_flat,
+                                self.perm, self.rand_h, self.rand_s,
+                                self.output_dim,
+                                self.fft_len, self.compute_size,
+                                self.fft_lut, self.fft_bitrev)
 
+        cbp = tf.reshape(cbp_flat, [tf.shape(bottom1)[0],
+                                    bottom1.get_shape()[1],
+                                    bottom1.get_shape()[2],
+                                    self.output_dim])
 
-    cbp_flat = tf.math.real(_ifft(fft_product, sequential))
+        return cbp
 
 
-    cbp = tf.reshape(cbp_flat, (-1,bottom1.get_shape()[1],bottom1.get_shape()[2],bottom1.get_shape()[3]))
-
-    return cbp
+def compact_bilinear_pooling_layer(bottom1, bottom2, output_dim,
+    seed_h_1=1, seed_s_1=3, seed_h_2=5, seed_s_2=7, compute_size=4096):
+    """
+    Functional wrapper around `CompactBilinearPooling`, kept for callers of
+    the original layer function. See the class docstring for details.
+    """
+    return CompactBilinearPooling(
+        output_dim, seed_h_1=seed_h_1, seed_s_1=seed_s_1,
+        seed_h_2=seed_h_2, seed_s_2=seed_s_2,
+        compute_size=compute_size)([bottom1, bottom2])
@@ -19,6 +19,10 @@ class DetectNoise:
         self.epochs = epochs
         self.batch_size = batch_size
         self.opt = AdamOptWrapper(learning_rate=0.0001, beta_1=0.5)
+        train_sig = [tf.TensorSpec([None, inputH, inputW, channel], tf.float32)] * 2
+        self.train_step = tf.function(self._train_step,
+                                      input_signature=train_sig,
+                                      jit_compile=True)
         self.Feature_extraction_net = feature_extraction_net
         self.Prediction_net = self.Prediction_network()
 
@@ -28,10 +32,10 @@ class DetectNoise:
 
     def train(self,x_original,x_adv):
 
-        x_original = tf.data.Dataset.from_tensor_slices(x_original)
+        x_original = tf.data.Dataset.from_tensor_slices(tf.cast(x_original, tf.float32))
         x_original = x_original.batch(self.batch_size)
 
-        x_adv = tf.data.Dataset.from_tensor_slices(x_adv)
+        x_adv = tf.data.Dataset.from_tensor_slices(tf.cast(x_adv, tf.float32))
         x_adv = x_adv.batch(self.batch_size)
 
         train_loss = tf.keras.metrics.Mean()
@@ -47,19 +51,16 @@ class DetectNoise:
                 print('loss:',cost.numpy())
                 train_loss.reset_states()
 
-    @tf.function
-    def train_step(self, x_o,x_a):
-        y = tf.concat([np.ones((x_o.shape[0],1),dtype=int),np.zeros((x_a.shape[0],1),dtype=int)],axis=0)
+    def _train_step(self, x_o,x_a):
+        y = tf.concat([tf.ones([tf.shape(x_o)[0], 1], dtype=tf.int32),
+                       tf.zeros([tf.shape(x_a)[0], 1], dtype=tf.int32)], axis=0)
         with tf.GradientTape() as t:
             x_input = tf.concat([x_o, x_a], 0)
 
             outputs = self.Prediction_net(x_input,training=True)
             loss = tf.reduce_mean(tf.keras.losses.sparse_categorical_crossentropy(y,outputs))
 
-            loss_regularization = []
-            for p in self.Prediction_net.trainable_variables:
-                loss_regularization.append(tf.nn.l2_loss(p))
-            loss_regularization = tf.reduce_sum(tf.stack(loss_regularization))
+            loss_regularization = tf.add_n([tf.nn.l2_loss(p) for p in self.Prediction_net.trainable_variables])
             cost = loss + 0.0005* loss_regularization
 
         grad = t.gradient(cost, self.Prediction_net.trainable_variables)